@@ -9,12 +9,18 @@
 
 # Zookeeper
 MAX_IP_TRIES = 5
+MAX_IP_SAMPLE_TRIES = 32
 ZK_TIMEOUT = 60
+ZK_CONN_RETRY_MAX_DELAY = 60
+ZK_COMMAND_RETRIES = 5
+ZK_ERROR_RETRY_DELAY = 1
+ZK_SYNC_TIMEOUT = 5
 TIME_DELAY_MIN = 30
 TIME_DELAY_MAX = 60
 DEFAULT_SLEEP = 600
 DEFAULT_MAX_CHANGE_THRESHOLD = 20
 METADATA_URL = "http://169.254.169.254/latest/meta-data/"
+METADATA_TIMEOUT = 3.0
 INSTANCE_ID_PATH = "instance-id"
 PUBLIC_ADDRESS_PATH = "public-ipv4"
 PRIVATE_ADDRESS_PATH = "local-ipv4"
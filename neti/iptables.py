@@ -7,25 +7,69 @@
 #  of patent rights can be found in the PATENTS file in the same directory.
 #
 
+import hashlib
 import logging
-import md5
 import os
 import re
+import socket
 import subprocess
 import sys
-import tempfile
 
 import neti.constants as constants
 
-from ipaddress import IPv4Network
 from neti.exceptions import BadIPTablesError, InvalidIPtablesVersionError, InvalidIPSetVersionError, MissingBinaryError, InvalidChainError, InvalidIPError, AddressValueError
-from shutil import copy2
 
 logger = logging.getLogger('neti')
 
+_VALID_IP_CACHE_SIZE = 4096
+_valid_ip_cache = set()
+
+# Discovered binary paths and the ipset legacy flag, cached at module level —
+# the watch callback builds IPtables objects repeatedly and the installed
+# binaries do not change under us.
+_binary_paths = None
+_legacy_ipset = None
+
+
+def _valid_ipv4(ip):
+    """ Validates a dotted-quad IPv4 string without building an IPv4Network
+        object, caching known-good values since the party IP set is largely
+        stable across watch fires. """
+    if ip in _valid_ip_cache:
+        return True
+    if ip.count(".") != 3:
+        raise AddressValueError(ip)
+    try:
+        socket.inet_aton(ip)
+    except socket.error:
+        raise AddressValueError(ip)
+    if len(_valid_ip_cache) >= _VALID_IP_CACHE_SIZE:
+        _valid_ip_cache.clear()
+    _valid_ip_cache.add(ip)
+    return True
+
+
+def _valid_ipv4_or_cidr(ip):
+    """ Validates an IPv4 string with an optional /prefix. """
+    parts = ip.split("/")
+    if len(parts) > 2:
+        raise AddressValueError(ip)
+    if len(parts) == 2 and not (parts[1].isdigit() and int(parts[1]) <= 32):
+        raise AddressValueError(ip)
+    return _valid_ipv4(parts[0])
+
+
+def _format_nat_rule(chain, source_ip, dest_ip):
+    """ Formats a DNAT rule line without the NATRule object/validation
+        overhead — bundle IPs are already validated at parse time. """
+    return f"-A {chain} -d {source_ip} -j DNAT --to-destination {dest_ip}\n"
+
 
 class IPtables(object):
 
+    _NONDEC_RE = re.compile(r'[^\d.]+')
+    _IPSET_VERSION_RE = re.compile(r'protocol version:? (\d)')
+
     def __init__(self, config, is_vpc=False, dry_run=False):
         self._is_vpc = is_vpc
         self._get_all_binaries()
@@ -37,43 +81,51 @@ class IPtables(object):
         self.reject_all = config["reject_all"]
         self.table_files_path = config["table_files_path"]
         self.nat_overrides = config["nat_overrides"] or {}
+        self._last_entries = None
+        self._last_filter_ips = None
 
     def _get_all_binaries(self):
-        for binary in constants.BINARIES:
-            self._get_binary(binary)
+        global _binary_paths
+        if _binary_paths is None:
+            _binary_paths = dict((binary, self._get_binary(binary)) for binary in constants.BINARIES)
+        for binary, path in _binary_paths.items():
+            setattr(self, f"{binary.replace('-', '_')}_bin", path)
 
     def _get_binary(self, binary):
         try:
-            setattr(self, "%s_bin" % binary.replace("-", "_"), subprocess.check_output(["which", binary]).strip())
+            return subprocess.check_output(["which", binary], universal_newlines=True).strip()
         except subprocess.CalledProcessError:
             logger.error("No %s version found!" % binary)
             raise MissingBinaryError
 
     def _check_compatibility(self):
-        """ Checks binary compatibility. """
-        self._check_iptables_compatibility()
-        self._check_ipset_compatibility()
+        """ Checks binary compatibility (forked once and cached after that). """
+        global _legacy_ipset
+        if _legacy_ipset is None:
+            self._check_iptables_compatibility()
+            self._check_ipset_compatibility()
+            _legacy_ipset = self.legacy_ipset
+        else:
+            self.legacy_ipset = _legacy_ipset
 
     def _check_iptables_compatibility(self):
         """ Checks iptables binary compatibility. """
         try:
-            iptables_version_string = subprocess.check_output([self.iptables_bin, "-V"])
+            iptables_version_string = subprocess.check_output([self.iptables_bin, "-V"], universal_newlines=True)
         except subprocess.CalledProcessError:
             raise MissingBinaryError
-        non_decimal = re.compile(r'[^\d.]+')
-        version = non_decimal.sub('', iptables_version_string.split()[1])
-        if tuple(version.split(".")) < (1, 2, 10):
+        version = self._NONDEC_RE.sub('', iptables_version_string.split()[1])
+        if tuple(int(x) for x in version.split(".") if x) < (1, 2, 10):
             logger.error("iptables must be of version 1.2.10 or higher!")
             raise InvalidIPtablesVersionError
 
     def _check_ipset_compatibility(self):
         """ Checks ipset binary compatibility. """
         try:
-            ipset_version_string = subprocess.check_output([self.ipset_bin, "-v"])
+            ipset_version_string = subprocess.check_output([self.ipset_bin, "-v"], universal_newlines=True)
         except subprocess.CalledProcessError:
             raise MissingBinaryError
-        version_match = re.compile(r'protocol version:? (\d)')
-        res = version_match.search(ipset_version_string)
+        res = self._IPSET_VERSION_RE.search(ipset_version_string)
         if res:
             version = int(res.groups()[0])
             if version == 6:
@@ -83,135 +135,158 @@ class IPtables(object):
             raise InvalidIPSetVersionError
 
     def build(self, bundles):
-        """ Gets nodes from ZK, builds rule table, and pushes it live. """
+        """ Gets nodes from ZK, builds rule table, and pushes it live.  On
+            repeat builds only the ipset delta is applied; the full restore
+            and swap is reserved for the first build (or delta failure). """
         self._check_compatibility()
         num_entries = len(bundles)
         logger.info("%d party members" % num_entries)
-        if num_entries > 0:
-            with tempfile.NamedTemporaryFile() as temp:
-                self._gen_ipset_rules(temp, bundles)
-                self._push_ipset_live(temp)
-            for table in constants.TABLES:
-                with tempfile.NamedTemporaryFile() as temp:
-                    self._gen_rule_file(table, temp, bundles)
-                    self._push_iptables_live(table, temp)
-
-    def _gen_ipset_rules(self, temp, bundles):
+        if num_entries == 0:
+            return
+        entries = frozenset(bundle.entry for bundle in bundles)
+        if entries == self._last_entries:
+            logger.debug("Party membership unchanged...skipping rebuild")
+            return
+        filter_ips = {bundle.filter_ip(self._is_vpc) for bundle in bundles}
+        if self._last_filter_ips is None or not self._apply_ipset_delta(filter_ips):
+            self._push_ipset_live(self._gen_ipset_rules(bundles))
+        for table in constants.TABLES:
+            self._push_iptables_live(table, self._gen_rule_file(table, bundles))
+        self._last_entries = entries
+        self._last_filter_ips = filter_ips
+
+    def _apply_ipset_delta(self, new_ips):
+        """ Adds/deletes only the changed IPs on the live production set.
+            :returns: True if the delta was applied. """
+        if self.dry_run:
+            return False
+        added = new_ips - self._last_filter_ips
+        removed = self._last_filter_ips - new_ips
+        try:
+            for ip in added:
+                subprocess.check_output([self.ipset_bin, "-A", constants.IPSET_PROD, ip], stderr=subprocess.STDOUT, universal_newlines=True)
+            for ip in removed:
+                subprocess.check_output([self.ipset_bin, "-D", constants.IPSET_PROD, ip], stderr=subprocess.STDOUT, universal_newlines=True)
+        except subprocess.CalledProcessError as e:
+            logger.error("Error applying ipset delta: %s...falling back to full rebuild" % e.output.strip())
+            return False
+        return True
+
+    def _gen_ipset_rules(self, bundles):
         """ Writes the main ipset set (not caring about the return value...just making sure it's there)
-            and builds the new set of IPs. """
+            and builds the new set of IPs.  :returns: Rule string for ipset -R. """
 
         self._install_ipset(constants.IPSET_PROD)
-        temp.write("%s\n" % self._gen_ipset(constants.IPSET_STAGING))
         ignore_str = "-! "
         if self.legacy_ipset:
             ignore_str = ""
-        for bundle in bundles:
-            temp.write("%s-A %s %s\n" % (ignore_str, constants.IPSET_STAGING, bundle.filter_ip(self._is_vpc)))
-        temp.write("COMMIT\n")
-        temp.flush()
+        parts = [f"{self._gen_ipset(constants.IPSET_STAGING)}\n"]
+        parts.extend(f"{ignore_str}-A {constants.IPSET_STAGING} {bundle.filter_ip(self._is_vpc)}\n" for bundle in bundles)
+        parts.append("COMMIT\n")
+        return "".join(parts)
 
     def _install_ipset(self, set_name):
         try:
             command = [self.ipset_bin] + self._gen_ipset(set_name).split()
-            subprocess.check_output(command)
-        except subprocess.CalledProcessError, e:
+            subprocess.check_output(command, universal_newlines=True)
+        except subprocess.CalledProcessError as e:
             if e.returncode != 1:
                 logger.error("Error inserting ipset: %s" % e.output)
 
     def _gen_ipset(self, set_name):
         hashsize_opt = ""
         if "hash" in constants.IPSET_TYPE:
-            hashsize_opt = "--hashsize %d" % constants.IPSET_HASHSIZE
-        return "-N %s %s %s" % (set_name, constants.IPSET_TYPE, hashsize_opt)
+            hashsize_opt = f"--hashsize {constants.IPSET_HASHSIZE}"
+        return f"-N {set_name} {constants.IPSET_TYPE} {hashsize_opt}"
 
-    def _push_ipset_live(self, temp):
-        """ Writes the new list to a staging set, atomically swaps the main and staging sets,
+    def _push_ipset_live(self, rules):
+        """ Pipes the new list into a staging set, atomically swaps the main and staging sets,
             and finally deletes the staging set. (Yes, it's ridiculous that it can't do this internally,
             but it's our best option) """
 
+        out, returncode = self._run_with_input([self.ipset_bin, "-R"], rules)
+        if returncode != 0:
+            logger.error("Error in ipset rule file: %s" % out.strip())
         try:
-            temp.seek(0)
-            subprocess.check_output([self.ipset_bin, "-R"], stdin=temp, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError, e:
-            logger.error("Error in ipset rule file: %s" % e.output.strip())
-        try:
-            subprocess.check_output([self.ipset_bin, "-W", constants.IPSET_STAGING, constants.IPSET_PROD])
-        except subprocess.CalledProcessError, e:
+            subprocess.check_output([self.ipset_bin, "-W", constants.IPSET_STAGING, constants.IPSET_PROD], universal_newlines=True)
+        except subprocess.CalledProcessError as e:
             logger.error("Error swapping ipset rule file: %s" % e.output)
         try:
-            subprocess.check_output([self.ipset_bin, "-X", constants.IPSET_STAGING])
-        except subprocess.CalledProcessError, e:
+            subprocess.check_output([self.ipset_bin, "-X", constants.IPSET_STAGING], universal_newlines=True)
+        except subprocess.CalledProcessError as e:
             logger.error("Error deleting staging ipset rule file: %s" % e.output)
 
-    def _gen_rule_file(self, table, temp, bundles):
-        """ Generates rule file for the iptables-restore command. """
-        temp.write(constants.IPTABLES_BASE[table])
+    def _run_with_input(self, command, rules):
+        """ Runs a command with the rule string piped over stdin, avoiding the
+            temp-file lifecycle.  :returns: (combined output, return code). """
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        out, _ = process.communicate(rules)
+        return out, process.returncode
+
+    def _gen_rule_file(self, table, bundles):
+        """ Generates the rule string for the iptables-restore command. """
+        parts = [constants.IPTABLES_BASE[table]]
         if table == "filter":
             for port in self.open_ports:
                 if port:
-                    temp.write("-A INPUT -p tcp --dport %s -m state --state NEW,ESTABLISHED -j ACCEPT\n" % port)
-                    temp.write("-A OUTPUT -o eth0 -p tcp --sport %s -m state --state ESTABLISHED -j ACCEPT\n" % port)
+                    parts.append(f"-A INPUT -p tcp --dport {port} -m state --state NEW,ESTABLISHED -j ACCEPT\n")
+                    parts.append(f"-A OUTPUT -o eth0 -p tcp --sport {port} -m state --state ESTABLISHED -j ACCEPT\n")
             if self.reject_all:
-                temp.write("-P INPUT DROP\n")
+                parts.append("-P INPUT DROP\n")
             else:
-                temp.write("-P INPUT ACCEPT\n")
+                parts.append("-P INPUT ACCEPT\n")
             if self._is_vpc:
-                temp.write(str(FilterRule("INPUT", "10.0.0.0/8")))
+                parts.append(str(FilterRule("INPUT", "10.0.0.0/8")))
             if len(self.ssh_whitelist) > 0:
                 for ip in self.ssh_whitelist:
-                    temp.write(str(FilterRule("ssh_whitelist", ip, dest_port=22)))
+                    parts.append(str(FilterRule("ssh_whitelist", ip, dest_port=22)))
 
         elif table == "nat":
             for bundle in bundles:
                 nat_ips = bundle.NAT_ips(self._is_vpc)
-                temp.write(str(NATRule("OUTPUT", nat_ips["overlay_ip"], nat_ips["dest_ip"])))
-            for src, dst in self.nat_overrides.iteritems():
-                temp.write(str(NATRule("OUTPUT", src, dst)))
+                parts.append(_format_nat_rule("OUTPUT", nat_ips["overlay_ip"], nat_ips["dest_ip"]))
+            parts.extend(str(NATRule("OUTPUT", src, dst)) for src, dst in self.nat_overrides.items())
 
-        temp.write("COMMIT\n")
-        temp.flush()
+        parts.append("COMMIT\n")
+        return "".join(parts)
 
-    def _push_iptables_live(self, table, temp):
-        """ Runs a syntax check on the IPtables rule file and loads it into the system if it passes.  If _dry_run
-            is set, it prints the rule file to stdout. """
+    def _push_iptables_live(self, table, rules):
+        """ Runs a syntax check on the IPtables rule string and pipes it into the system if it passes.  If _dry_run
+            is set, it prints the rules to stdout. """
 
-        temp.seek(0)
-        current_table, update_table = self._table_needs_update(table, temp)
+        table_path, update_table = self._table_needs_update(table, rules)
         if update_table:
-            try:
-                subprocess.check_output([self.iptables_restore_bin, "-t", temp.name])
-            except subprocess.CalledProcessError, e:
-                logger.error("Error in iptables rule file: %s" % e.output)
-                raise BadIPTablesError(e.output)
+            out, returncode = self._run_with_input([self.iptables_restore_bin, "-t"], rules)
+            if returncode != 0:
+                logger.error("Error in iptables rule file: %s" % out)
+                raise BadIPTablesError(out)
             if self.dry_run:
-                temp.seek(0)
-                print temp.read()
+                print(rules)
                 sys.exit(0)
             else:
-                try:
-                    subprocess.check_output([self.iptables_restore_bin, "-v", temp.name])
-                    copy2(temp.name, current_table.name)
-                except subprocess.CalledProcessError, e:
-                    logger.error("Error in iptables rule file: %s" % e.output)
-
-    def _table_needs_update(self, table, temp):
-        update_table = True
+                out, returncode = self._run_with_input([self.iptables_restore_bin], rules)
+                if returncode != 0:
+                    logger.error("Error in iptables rule file: %s" % out)
+                else:
+                    with open(table_path, "w") as current_table:
+                        current_table.write(rules)
+
+    def _table_needs_update(self, table, rules):
         if not os.path.exists(self.table_files_path):
             os.makedirs(self.table_files_path)
+        table_path = f"{self.table_files_path}/{table}"
         try:
-            current_table = open("%s/%s" % (self.table_files_path, table), "r+")
-            if self._tables_match(current_table, temp):
-                logger.debug("%s table matches current...skipping" % table)
-                update_table = False
+            with open(table_path, "r") as current_table:
+                if self._tables_match(current_table.read(), rules):
+                    logger.debug("%s table matches current...skipping" % table)
+                    return (table_path, False)
         except IOError:
-            current_table = open("%s/%s" % (self.table_files_path, table), "w")
-        finally:
-            current_table.close()
-            return (current_table, update_table)
-
-    def _tables_match(self, current_table, new_table):
-        old = md5.new(current_table.read())
-        new = md5.new(new_table.read())
+            pass
+        return (table_path, True)
+
+    def _tables_match(self, current_rules, new_rules):
+        old = hashlib.md5(current_rules.encode())
+        new = hashlib.md5(new_rules.encode())
         return old.digest() == new.digest()
 
 
@@ -225,15 +300,15 @@ class FilterRule(object):
         self._validate()
         dport = ""
         if dest_port:
-            dport = "-p tcp --dport %d" % dest_port
-        self.rule = "-A %s -s %s %s -j ACCEPT\n" % (chain, self.source_ip, dport)
+            dport = f"-p tcp --dport {dest_port}"
+        self.rule = f"-A {chain} -s {self.source_ip} {dport} -j ACCEPT\n"
 
     def __str__(self):
         return self.rule
 
     def _validate(self):
         try:
-            IPv4Network(unicode(self.source_ip))
+            _valid_ipv4_or_cidr(self.source_ip)
         except AddressValueError:
             logger.error("Invalid IP specified in NAT rule!")
             raise InvalidIPError(self.source_ip)
@@ -251,7 +326,7 @@ class NATRule(object):
         self.source_ip = source_ip
         self.dest_ip = dest_ip
         self._validate()
-        self.rule = "-A %s -d %s -j DNAT --to-destination %s\n" % (chain, self.source_ip, self.dest_ip)
+        self.rule = _format_nat_rule(chain, self.source_ip, self.dest_ip)
 
     def __str__(self):
         return self.rule
@@ -259,7 +334,7 @@ class NATRule(object):
     def _validate(self):
         for ip in [self.source_ip, self.dest_ip]:
             try:
-                IPv4Network(unicode(ip))
+                _valid_ipv4_or_cidr(ip)
             except AddressValueError:
                 raise InvalidIPError(ip)
         if self.chain not in self.CHAINS:
@@ -10,19 +10,24 @@
 import boto
 import logging
 import random
-import re
 import requests
+import signal
+import socket
+import struct
+import threading
 
 import neti.constants as constants
 
-from ipaddress import AddressValueError, IPv4Address, IPv4Network
+from ipaddress import IPv4Network
 from kazoo.client import KazooClient, KazooState
 from kazoo.exceptions import NodeExistsError, NoNodeError, ZookeeperError
+from kazoo.handlers.threading import SequentialThreadingHandler
+from kazoo.retry import KazooRetry
 from kazoo.recipe.party import ShallowParty
 from kazoo.recipe.watchers import ChildrenWatch
 from neti import __version__ as version
-from neti.exceptions import IPPatternMismatchError, MetadataError, NoAvailableIPsError
-from neti.iptables import IPtables
+from neti.exceptions import AddressValueError, IPPatternMismatchError, MetadataError, NoAvailableIPsError
+from neti.iptables import IPtables, _valid_ipv4
 
 logger = logging.getLogger('neti')
 kazoo_logger = logging.getLogger('kazoo')
@@ -31,15 +36,23 @@ kazoo_logger = logging.getLogger('kazoo')
 class Connection(object):
 
     def __init__(self, config, dry_run=False):
+        self._is_vpc_cached = None
+        self._ec2 = None
+        self._metadata_session = requests.session()
         if self._is_vpc:
             self.zk_hosts = config["zk_hosts"]["vpc"]
         else:
             self.zk_hosts = config["zk_hosts"]["ec2"]
-        self.zk = KazooClient(hosts=",".join(self.zk_hosts), timeout=constants.ZK_TIMEOUT, logger=kazoo_logger)
+        self.zk = KazooClient(hosts=",".join(self.zk_hosts),
+                              timeout=constants.ZK_TIMEOUT,
+                              logger=kazoo_logger,
+                              handler=SequentialThreadingHandler(),
+                              connection_retry=KazooRetry(max_tries=-1, max_delay=constants.ZK_CONN_RETRY_MAX_DELAY, backoff=2),
+                              command_retry=KazooRetry(max_tries=constants.ZK_COMMAND_RETRIES, delay=0.1))
         self.aws_access_key_id = config["aws_key"]
         self.aws_secret_access_key = config["aws_secret_key"]
         self.overlay_subnet = config["overlay_subnet"]
-        self.network = IPv4Network(unicode(self.overlay_subnet))
+        self.network = IPv4Network(self.overlay_subnet)
         self.instance_id = self._get_instance_id()
         self.public_ip = self._get_public_ip()
         self.private_ip = self._get_private_ip()
@@ -53,8 +66,8 @@ class Connection(object):
 
     def _get_metadata(self, path):
         if not path:
-            raise "Metadata path cannot be empty!"
-        res = requests.get("%s%s" % (constants.METADATA_URL, path))
+            raise MetadataError("Metadata path cannot be empty!")
+        res = self._metadata_session.get(f"{constants.METADATA_URL}{path}", timeout=constants.METADATA_TIMEOUT)
         if res.status_code == 200:
             return str(res.text)
         else:
@@ -62,6 +75,11 @@ class Connection(object):
 
     @property
     def _is_vpc(self):
+        if self._is_vpc_cached is None:
+            self._is_vpc_cached = self._compute_is_vpc()
+        return self._is_vpc_cached
+
+    def _compute_is_vpc(self):
         try:
             self._get_metadata(constants.VPCID_PATH % self._get_mac())
             return True
@@ -83,12 +101,18 @@ class Connection(object):
     def _get_private_ip(self):
         return self._get_metadata(constants.PRIVATE_ADDRESS_PATH)
 
+    @property
+    def ec2(self):
+        """ :returns: Memoized EC2 API connection. """
+        if self._ec2 is None:
+            self._ec2 = boto.connect_ec2(aws_access_key_id=self.aws_access_key_id, aws_secret_access_key=self.aws_secret_access_key)
+        return self._ec2
+
     def tag_instance(self, data):
         try:
-            ec2 = boto.connect_ec2(aws_access_key_id=self.aws_access_key_id, aws_secret_access_key=self.aws_secret_access_key)
-            if not ec2.create_tags([self.instance_id], data):
+            if not self.ec2.create_tags([self.instance_id], data):
                 logger.error("Could not tag instance with %s" % data)
-        except boto.exception.BotoServerError, e:
+        except boto.exception.BotoServerError as e:
             logger.error("Could not tag instance due to boto error: %s" % e)
 
 
@@ -97,21 +121,24 @@ class Registry(object):
     def __init__(self, config, conn, dry_run=False):
         self.config = config
         self.zk_prefix = self.config["zk_prefix"]
-        self.zk_iptoid_path = "%s/%s" % (self.zk_prefix, self.config["zk_iptoid_node"])
-        self.zk_idtoip_path = "%s/%s" % (self.zk_prefix, self.config["zk_idtoip_node"])
-        self.zk_ip_map_path = "%s/%s" % (self.zk_prefix, self.config["zk_ip_map_node"])
-        self.zk_max_change_threshold_path = "%s/%s" % (self.zk_prefix, self.config["zk_max_change_threshold_path"])
+        self.zk_iptoid_path = f"{self.zk_prefix}/{self.config['zk_iptoid_node']}"
+        self.zk_idtoip_path = f"{self.zk_prefix}/{self.config['zk_idtoip_node']}"
+        self.zk_ip_map_path = f"{self.zk_prefix}/{self.config['zk_ip_map_node']}"
+        self.zk_max_change_threshold_path = f"{self.zk_prefix}/{self.config['zk_max_change_threshold_path']}"
         self.conn = conn
         self.dry_run = dry_run
+        self._builder = None
+        self._bundle_cache = {}
+        self._stop = threading.Event()
 
     @property
     def _zk_id_path(self):
         """ :returns: ID to IP mapping path for this instance. """
-        return "%s/%s" % (self.zk_idtoip_path, self.conn.instance_id)
+        return f"{self.zk_idtoip_path}/{self.conn.instance_id}"
 
     def _zk_ip_path(self, ip):
         """ :returns: IP to ID mapping path for this IP. """
-        return "%s/%s" % (self.zk_iptoid_path, ip)
+        return f"{self.zk_iptoid_path}/{ip}"
 
     def _tag_instance(self):
         """ Tag "overlay_ip" and "neti_version" on instance with registered overlay_ip """
@@ -119,18 +146,38 @@ class Registry(object):
 
     def _choose_overlay_ip(self):
         """
-        Get list of used IPs from ZK and randomly choose one from the rest of the subnet.
+        Get list of used IPs from ZK and randomly choose one from the rest of the subnet.  Samples random
+        host integers first — constant work on a sparsely used subnet, regardless of mask size — and only
+        enumerates the full range when sampling keeps colliding (i.e. the subnet is nearly full).
         :returns: String containing chosen IP.
         """
         try:
-            used_ips = {IPv4Address(unicode(ip)) for ip in self.conn.zk.get_children(self.zk_iptoid_path)}
+            self.conn.zk.sync_async(self.zk_iptoid_path).get(timeout=constants.ZK_SYNC_TIMEOUT)
+        except Exception as e:
+            logger.warn("ZK sync before IP allocation failed (%r)...reading anyway" % e)
+        children_async = self.conn.zk.get_children_async(self.zk_iptoid_path)
+        try:
+            children = children_async.get()
         except NoNodeError:
-            used_ips = set()
-        available_ips = set(self.conn.network.hosts()) - used_ips
+            children = []
+        base = int(self.conn.network.network_address) + 1
+        num_hosts = self.conn.network.num_addresses - 2
+        used_ips = set()
+        for ip in children:
+            try:
+                used_ips.add(struct.unpack("!I", socket.inet_aton(ip))[0])
+            except socket.error:
+                logger.warn("Ignoring malformed IP node %s" % ip)
+        if len(used_ips) < num_hosts:
+            for _ in range(constants.MAX_IP_SAMPLE_TRIES):
+                candidate = random.randint(base, base + num_hosts - 1)
+                if candidate not in used_ips:
+                    return socket.inet_ntoa(struct.pack("!I", candidate))
+        available_ips = [ip for ip in range(base, base + num_hosts) if ip not in used_ips]
         if not available_ips:
             logger.error("No available IPs found!")
             raise NoAvailableIPsError
-        return str(random.sample(available_ips, 1)[0])
+        return socket.inet_ntoa(struct.pack("!I", random.choice(available_ips)))
 
     def _find_available_overlay_ip(self):
         """
@@ -142,32 +189,28 @@ class Registry(object):
         ip = self._choose_overlay_ip()
         while retries < constants.MAX_IP_TRIES:
             retries += 1
-            try:
-                self.conn.zk.create(self._zk_id_path, ip)
-                logger.warn("Creating %s" % ip)
-            except NoNodeError:
+            logger.warn("Creating %s" % ip)
+            tx = self.conn.zk.transaction()
+            tx.create(self._zk_id_path, ip.encode())
+            result = tx.commit()[0]
+            if isinstance(result, NoNodeError):
                 self.conn.zk.ensure_path(self.zk_idtoip_path)
                 logger.error("Path %s did not exist...creating and trying again" % self.zk_idtoip_path)
                 continue
-            except NodeExistsError:
+            elif isinstance(result, NodeExistsError):
                 try:
                     zk_ip, _ = self.conn.zk.get(self._zk_id_path)
-                    logger.error("IP %s already assigned to %s...using that" % (zk_ip, self.conn.instance_id))
                 except NoNodeError:
                     logger.error("No IP found...trying again")
                     continue
-                return zk_ip
-            try:
-                zk_ip, _ = self.conn.zk.get(self._zk_id_path)
-            except NoNodeError:
-                logger.error("IP %s did not get associated...trying again" % ip)
-                continue
-            if zk_ip == ip:
-                logger.info("IP %s set" % ip)
-                return ip
-            else:
+                zk_ip = zk_ip.decode()
                 logger.error("IP %s already assigned to %s...using that" % (zk_ip, self.conn.instance_id))
                 return zk_ip
+            elif isinstance(result, Exception):
+                logger.error("Could not create %s (%r)...trying again" % (ip, result))
+                continue
+            logger.info("IP %s set" % ip)
+            return ip
 
         logger.error("No available IPs found!")
         raise NoAvailableIPsError
@@ -175,13 +218,12 @@ class Registry(object):
     def _set_ip_to_id_map(self, ip):
         """ Sets the reverse map for IP-based lookups. """
         try:
-            self.conn.zk.set(self._zk_ip_path(ip), self.conn.instance_id)
+            self.conn.zk.set(self._zk_ip_path(ip), self.conn.instance_id.encode())
         except NoNodeError:
             logger.info("No IP to ID map node for %s" % ip)
             try:
-                self.conn.zk.create(self._zk_ip_path(ip), self.conn.instance_id)
-            except NoNodeError:
-                self.conn.zk.ensure_path(self._zk_ip_path(ip))
+                self.conn.zk.create(self._zk_ip_path(ip), self.conn.instance_id.encode(), makepath=True)
+            except NodeExistsError:
                 self._set_ip_to_id_map(ip)
 
     def register(self):
@@ -189,7 +231,8 @@ class Registry(object):
         is set correctly, set the instance variable, and tag the instance.  If it fails, attempt to get a new one.
         :returns: String containing overlay IP. """
         try:
-            self.overlay_ip, _ = self.conn.zk.get(self._zk_id_path)
+            overlay_ip, _ = self.conn.zk.get(self._zk_id_path)
+            self.overlay_ip = overlay_ip.decode()
         except NoNodeError:
             self.overlay_ip = self._find_available_overlay_ip()
         self.conn.zk.handler.spawn(self._tag_instance)
@@ -198,7 +241,7 @@ class Registry(object):
 
     def _get_ip_map(self):
         """ :returns: Mapping of all IPs for znode """
-        return "%s|%s|%s|%d" % (self.conn.public_ip, self.conn.private_ip, self.overlay_ip, self.conn._is_vpc)
+        return f"{self.conn.public_ip}|{self.conn.private_ip}|{self.overlay_ip}|{int(self.conn._is_vpc)}"
 
     def _ips_from_entries(self, entries):
         """ Builds array of InstanceIPBundles from found ZK nodes.
@@ -208,6 +251,20 @@ class Registry(object):
             ips.append(InstanceIPBundle(entry))
         return ips
 
+    def _update_bundle_cache(self, entries):
+        """ Parses only entries that are not already cached and drops departed
+            ones, so each watch fire costs O(delta) parses rather than O(N).
+            :returns: (added, removed) entry sets. """
+        current = set(entries)
+        cached = set(self._bundle_cache)
+        added = current - cached
+        removed = cached - current
+        for entry in removed:
+            del self._bundle_cache[entry]
+        for entry in added:
+            self._bundle_cache[entry] = InstanceIPBundle(entry)
+        return added, removed
+
     def _join_party(self):
             self.party = ShallowParty(self.conn.zk, self.zk_ip_map_path, identifier=self._get_ip_map())
             self.party.join()
@@ -218,7 +275,7 @@ class Registry(object):
             return int(param) if param else default
         except NoNodeError:
             self.conn.zk.ensure_path(path)
-            self.conn.zk.retry(self.conn.zk.set, (path, str(default)))
+            self.conn.zk.retry(self.conn.zk.set, path, str(default).encode())
             return default
 
     def _state_listener(self, state):
@@ -243,37 +300,55 @@ class Registry(object):
             self.conn.lost = False
 
     def run(self):
-        """ Connects to both ZKs, inserts an ephemeral node, and starts a watch for changes. """
-        try:
-            self._join_party()
-            self.conn.zk.add_listener(self._state_listener)
-
-            @ThrottledChildrenWatch(self.conn.zk, self.zk_ip_map_path, delay_min=constants.TIME_DELAY_MIN, delay_max=constants.TIME_DELAY_MAX)
-            def update_iptables(hosts):
-                self.max_change_threshold = self._load_param(self.zk_max_change_threshold_path, constants.DEFAULT_MAX_CHANGE_THRESHOLD)
-                if getattr(self, "hosts", None):
-                    hosts_to_remove = len(self.hosts) - len(hosts)
-                    if hosts_to_remove > self.max_change_threshold:
-                        logger.warn("Trying to remove %d hosts...untriggering (max is %s)" % (hosts_to_remove, self.max_change_threshold))
+        """ Connects to ZK, inserts an ephemeral node, and starts a watch for changes.  Setup is retried
+            iteratively on ZookeeperError — transient disconnects within a session are already handled by
+            the client's connection retry.  Blocks until SIGTERM, then closes the ZK session so our
+            ephemeral nodes go away immediately instead of lingering for the session timeout. """
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stop.set())
+        while not self._stop.is_set():
+            try:
+                self._join_party()
+                self.conn.zk.add_listener(self._state_listener)
+                if self._builder is None:
+                    self._builder = IPtables(config=self.config, is_vpc=self.conn._is_vpc, dry_run=self.dry_run)
+
+                @ThrottledChildrenWatch(self.conn.zk, self.zk_ip_map_path, delay_min=constants.TIME_DELAY_MIN, delay_max=constants.TIME_DELAY_MAX)
+                def update_iptables(hosts):
+                    self.max_change_threshold = self._load_param(self.zk_max_change_threshold_path, constants.DEFAULT_MAX_CHANGE_THRESHOLD)
+                    if getattr(self, "hosts", None):
+                        hosts_to_remove = len(self.hosts) - len(hosts)
+                        if hosts_to_remove > self.max_change_threshold:
+                            logger.warn("Trying to remove %d hosts...untriggering (max is %s)" % (hosts_to_remove, self.max_change_threshold))
+                            return
+                        else:
+                            remove = set(self.hosts) - set(hosts)
+                            add = set(hosts) - set(self.hosts)
+                            if add:
+                                logger.debug("Adding: %s" % add)
+                            if remove:
+                                logger.debug("Removing: %s" % remove)
+                    self.hosts = hosts
+                    added, removed = self._update_bundle_cache(self.hosts)
+                    if not added and not removed:
+                        logger.debug("No party changes...skipping build")
                         return
-                    else:
-                        remove = set(self.hosts) - set(hosts)
-                        add = set(hosts) - set(self.hosts)
-                        if add:
-                            logger.debug("Adding: %s" % add)
-                        if remove:
-                            logger.debug("Removing: %s" % remove)
-                self.hosts = hosts
-                bundles = self._ips_from_entries(self.hosts)
-                builder = IPtables(config=self.config, is_vpc=self.conn._is_vpc, dry_run=self.dry_run)
-                builder.build(bundles)
-
-            while True:
-                self.conn.zk.handler.sleep_func(constants.DEFAULT_SLEEP)
-
-        except ZookeeperError as e:
-            logger.error("ZookeeperError: %s" % e)
-            self.run()
+                    try:
+                        self._builder.build([self._bundle_cache[entry] for entry in sorted(self._bundle_cache)])
+                    except Exception:
+                        self._bundle_cache.clear()
+                        raise
+
+                break
+
+            except ZookeeperError as e:
+                logger.error("ZookeeperError: %s" % e)
+                self.conn.zk.handler.sleep_func(constants.ZK_ERROR_RETRY_DELAY)
+
+        while not self._stop.is_set():
+            self._stop.wait(constants.DEFAULT_SLEEP)
+        logger.warn("Received stop signal...closing ZK session")
+        self.conn.zk.stop()
+        self.conn.zk.close()
 
 
 class ThrottledChildrenWatch(ChildrenWatch):
@@ -323,33 +398,22 @@ class InstanceIPBundle(object):
 
     def _parse_entry(self):
         """ Matches ZK node to pattern and sets all IP instance variables. """
-        try:
-            _, ip_string = self.entry.split(self.uuid_delim)
-        except ValueError:
+        parts = self.entry.split(self.uuid_delim, 1)
+        if len(parts) != 2:
             logger.error("Invalid ZK entry %s" % self.entry)
             raise IPPatternMismatchError(self.entry)
-        binary_check = re.compile('[01]')
-        try:
-            self.is_vpc = ip_string.rsplit(self.ip_delim, 1)[1]
-        except ValueError:
+        fields = parts[1].split(self.ip_delim)
+        if len(fields) != len(self.ip_labels) + 1:
             logger.error("Invalid ZK entry %s" % self.entry)
             raise IPPatternMismatchError(self.entry)
-        if not binary_check.match(self.is_vpc):
+        is_vpc = fields.pop()
+        if is_vpc not in ("0", "1"):
             raise IPPatternMismatchError(self.entry)
-        try:
-            ips = dict(zip(self.ip_labels, ip_string.split(self.ip_delim)))
-        except ValueError:
-            logger.error("Invalid ZK entry %s" % self.entry)
-            raise IPPatternMismatchError(self.entry)
-        if len(ips) != len(self.ip_labels):
-            logger.error("Invalid ZK entry %s" % self.entry)
-            raise IPPatternMismatchError(self.entry)
-
-        for label, ip in ips.iteritems():
+        for label, ip in zip(self.ip_labels, fields):
             try:
-                IPv4Network(unicode(ip))
+                _valid_ipv4(ip)
             except AddressValueError:
                 logger.error("Invalid IP found - %s:%s" % (label, ip))
                 raise IPPatternMismatchError(self.entry)
-            else:
-                setattr(self, label, ip)
+            setattr(self, label, ip)
+        self.is_vpc = is_vpc
@@ -52,11 +52,11 @@ ranges = [
 def authorize_ips(group, current_ips, sleep):
     for ip in current_ips:
         try:
-            print "Authorizing %s" % ip
+            print(f"Authorizing {ip}")
             group.authorize(ip_protocol="tcp", from_port=0, to_port=65535, cidr_ip=ip)
             group.authorize(ip_protocol="udp", from_port=0, to_port=65535, cidr_ip=ip)
         except EC2ResponseError:
-            print "Duplicate: %s" % ip
+            print(f"Duplicate: {ip}")
             continue
         time.sleep(sleep)
 
@@ -64,11 +64,11 @@ def authorize_ips(group, current_ips, sleep):
 def revoke_ips(group, current_ips, sleep):
     for ip in current_ips:
         try:
-            print "Revoking %s" % ip
+            print(f"Revoking {ip}")
             group.revoke(ip_protocol="tcp", from_port=0, to_port=65535, cidr_ip=ip)
             group.revoke(ip_protocol="udp", from_port=0, to_port=65535, cidr_ip=ip)
         except EC2ResponseError:
-            print "Duplicate: %s" % ip
+            print(f"Duplicate: {ip}")
             continue
         time.sleep(sleep)
 
@@ -25,9 +25,9 @@ ZK_HOSTS = [
 ]
 
 ZK_ROOT = "/neti"
-ZK_IP_MAP = "%s/ip-map" % ZK_ROOT
-ZK_IP_TO_ID = "%s/ip-to-id" % ZK_ROOT
-IP_NETWORK = IPv4Network(unicode("192.168.0.0/18"))
+ZK_IP_MAP = f"{ZK_ROOT}/ip-map"
+ZK_IP_TO_ID = f"{ZK_ROOT}/ip-to-id"
+IP_NETWORK = IPv4Network("192.168.0.0/18")
 
 conn = boto.connect_ec2()
 
@@ -41,7 +41,7 @@ def _try_int(s):
 
 def _natural_sorting_key(host):
     name = host.tags.get("Name") or host.public_dns_name
-    return map(_try_int, re.findall(r"(\d+|\D+)", name))
+    return [_try_int(part) for part in re.findall(r"(\d+|\D+)", name)]
 
 
 def get_aws_instances():
@@ -74,9 +74,9 @@ def get_neti_instances(zk):
 
 def ver_str(version):
     if version:
-        return tuple([int(i) for i in version.split(".")])
+        return tuple(int(i) for i in version.split("."))
     else:
-        return 0
+        return ()
 
 
 def main():
@@ -96,7 +96,7 @@ def main():
         close_neti_conn(zk)
         used_count = len(used_ips)
         total_count = len(set(IP_NETWORK.hosts()))
-        print "Used: %d; Total %d" % (used_count, total_count)
+        print(f"Used: {used_count}; Total {total_count}")
         return
 
     instances = get_aws_instances()
@@ -118,11 +118,11 @@ def main():
             table.add_row([i.tags.get('Name'), i.ip_address, i.private_ip_address, None, None, True if i.vpc_id else False])
     if args.overlays_only:
         table.header = False
-        print table.get_string(fields=["Overlay IP"])
+        print(table.get_string(fields=["Overlay IP"]))
     else:
-        print table
-        print "%d total instances, %d instances in Neti (%.0f%%)" % (total_instance_count,
-                                                                     total_in_neti, 100 * float(total_in_neti) / float(total_instance_count))
+        print(table)
+        print("%d total instances, %d instances in Neti (%.0f%%)" % (total_instance_count,
+                                                                      total_in_neti, 100 * float(total_in_neti) / float(total_instance_count)))
 
 
 if __name__ == "__main__":
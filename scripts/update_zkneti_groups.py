@@ -27,25 +27,25 @@ ec2_conn = connect_ec2(aws_access_key_id=aws_key, aws_secret_access_key=aws_secr
 
 
 def clean_old_ips(group, current_ips):
-    print "Checking for old IPs in %s" % group.name
+    print(f"Checking for old IPs in {group.name}")
     to_remove = []
     for rule in group.rules:
         if rule.from_port and int(rule.from_port) == ZK_PORT and int(rule.to_port) == ZK_PORT:
             for grant in rule.grants:
                 if grant.cidr_ip not in current_ips:
-                    print "Removing %s" % grant.cidr_ip
+                    print(f"Removing {grant.cidr_ip}")
                     to_remove.append(grant.cidr_ip)
             for cidr_ip in to_remove:
                 group.revoke(ip_protocol=rule.ip_protocol, from_port=rule.from_port, to_port=rule.to_port, cidr_ip=cidr_ip)
 
 
 def set_new_ips(group, current_ips):
-    print "Setting %d IPs in %s..." % (len(current_ips), group.name)
+    print(f"Setting {len(current_ips)} IPs in {group.name}...")
     for ip in current_ips:
         try:
             group.authorize(ip_protocol="tcp", from_port=ZK_PORT, to_port=ZK_PORT, cidr_ip=ip)
         except EC2ResponseError:
-            print "Duplicate: %s" % ip
+            print(f"Duplicate: {ip}")
             continue
 
 
@@ -55,18 +55,18 @@ def process_group(group, ips):
 
 
 def get_ips(group, filter_attr):
-    print "Getting hosts for %s" % group.name
+    print(f"Getting hosts for {group.name}")
     filter = {"instance-state-name": "running", filter_attr: group.id}
     res = ec2_conn.get_all_instances(filters=filter)
     hosts = [r.instances[0] for r in res]
     cidrs = []
     for i in hosts:
-        cidrs.append("%s/32" % i.ip_address)
+        cidrs.append(f"{i.ip_address}/32")
     return cidrs
 
 
 def get_group(id):
-    print "Getting security group %s" % id
+    print(f"Getting security group {id}")
     return ec2_conn.get_all_security_groups(filters={"group-id": id})[0]
 
 
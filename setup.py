@@ -21,9 +21,8 @@ setup(name='neti',
       scripts=['bin/neti'],
       install_requires=[
           'PyYAML',
-          'kazoo == 1.3.1',
-          'requests == 0.11.2',
-          'boto == 2.14.0',
-          'ipaddress == 1.0.6'
+          'kazoo >= 2.0',
+          'requests >= 2.4',
+          'boto >= 2.32'
       ]
       )
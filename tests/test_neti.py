@@ -15,13 +15,14 @@ from neti.iptables import IPtables
 import unittest
 
 from ipaddress import IPv4Address, IPv4Network
-from mock import Mock, patch
+from subprocess import CalledProcessError
+from unittest.mock import Mock, patch
 
 TESTING_CHROOT = "/testing/"
 TESTING_CONF = "conf/testing.yml"
 
 with open(TESTING_CONF, "r") as f:
-    config = yaml.load(f)
+    config = yaml.safe_load(f)
 
 
 def setup_mocks():
@@ -48,10 +49,10 @@ class NetiEC2Tests(NetiTestBase):
     def test_register_in_EC2(self):
         registry = Registry(config, self.conn)
         ip = registry.register()
-        self.assertEquals(IPv4Network(unicode(self.conn.overlay_subnet)), self.conn.network)
-        self.assertIn(IPv4Address(unicode(ip)), self.conn.network)
-        ip_to_id = self.conn.zk.get(registry._zk_ip_path(ip))[0]
-        id_to_ip = self.conn.zk.get(registry._zk_id_path)[0]
+        self.assertEquals(IPv4Network(self.conn.overlay_subnet), self.conn.network)
+        self.assertIn(IPv4Address(ip), self.conn.network)
+        ip_to_id = self.conn.zk.get(registry._zk_ip_path(ip))[0].decode()
+        id_to_ip = self.conn.zk.get(registry._zk_id_path)[0].decode()
         self.assertEquals(self.conn.instance_id, ip_to_id)
         self.assertEquals(ip, id_to_ip)
 
@@ -62,10 +63,10 @@ class NetiVPCTests(NetiTestBase):
     def test_register_in_VPC(self):
         registry = Registry(config, self.conn)
         ip = registry.register()
-        self.assertEquals(IPv4Network(unicode(self.conn.overlay_subnet)), self.conn.network)
-        self.assertIn(IPv4Address(unicode(ip)), self.conn.network)
-        ip_to_id = self.conn.zk.get(registry._zk_ip_path(ip))[0]
-        id_to_ip = self.conn.zk.get(registry._zk_id_path)[0]
+        self.assertEquals(IPv4Network(self.conn.overlay_subnet), self.conn.network)
+        self.assertIn(IPv4Address(ip), self.conn.network)
+        ip_to_id = self.conn.zk.get(registry._zk_ip_path(ip))[0].decode()
+        id_to_ip = self.conn.zk.get(registry._zk_id_path)[0].decode()
         self.assertEquals(self.conn.instance_id, ip_to_id)
         self.assertEquals(ip, id_to_ip)
 
@@ -120,16 +121,14 @@ class NetiIPtablesTests(NetiTestBase):
         for entry in entries:
             self.conn.zk.create("%s/%s" % (self.registry.zk_ip_map_path, entry))
 
-        def return_ipset_temp(temp):
-            temp.seek(0)
-            self.tempfiles["ipset"] = temp.read()
+        def return_ipset_rules(rules):
+            self.tempfiles["ipset"] = rules
 
-        def return_iptables_temp(table, temp):
-            temp.seek(0)
-            self.tempfiles[table] = temp.read()
+        def return_iptables_rules(table, rules):
+            self.tempfiles[table] = rules
 
-        IPtables._push_iptables_live = Mock(side_effect=return_iptables_temp)
-        IPtables._push_ipset_live = Mock(side_effect=return_ipset_temp)
+        IPtables._push_iptables_live = Mock(side_effect=return_iptables_rules)
+        IPtables._push_ipset_live = Mock(side_effect=return_ipset_rules)
 
     def build_file(self):
         self.build_ip_maps()
@@ -170,6 +169,53 @@ class NetiIPtablesTests(NetiTestBase):
         for nat in nat_overrides:
             self.assertIn(nat[0], self.tempfiles["nat"])
 
+
+class NetiIPtablesDeltaTests(unittest.TestCase):
+
+    entries = [
+        "acf847a7c6804f6e8e3346a93386a654-32.32.32.32|10.8.2.1|192.168.0.1|0",
+        "4d8e8617c68a46f89ceaef5bba33b3c0-32.32.32.33|10.8.2.2|192.168.0.2|0",
+        "46a30a0bd5a44e7899a87f08ad79e6ff-32.32.32.34|10.8.2.3|192.168.0.3|1"
+    ]
+
+    def setUp(self):
+        patch.object(IPtables, "_get_all_binaries").start()
+        patch.object(IPtables, "_check_compatibility").start()
+        self.install_ipset = patch.object(IPtables, "_install_ipset").start()
+        self.push_ipset = patch.object(IPtables, "_push_ipset_live").start()
+        self.push_iptables = patch.object(IPtables, "_push_iptables_live").start()
+        self.check_output = patch("neti.iptables.subprocess.check_output").start()
+        self.addCleanup(patch.stopall)
+        self.builder = IPtables(dict(config, ssh_whitelist=["10.1.1.1/32"]), is_vpc=False)
+        self.builder.ipset_bin = "/sbin/ipset"
+        self.builder.iptables_restore_bin = "/sbin/iptables-restore"
+
+    def _bundles(self, entries):
+        return [InstanceIPBundle(entry) for entry in entries]
+
+    def test_delta_applied_on_membership_change(self):
+        self.builder.build(self._bundles(self.entries[:2]))
+        self.assertEquals(self.push_ipset.call_count, 1)
+        self.builder.build(self._bundles(self.entries[1:]))
+        self.assertEquals(self.push_ipset.call_count, 1)
+        commands = [call[0][0] for call in self.check_output.call_args_list]
+        self.assertIn(["/sbin/ipset", "-A", constants.IPSET_PROD, "32.32.32.34"], commands)
+        self.assertIn(["/sbin/ipset", "-D", constants.IPSET_PROD, "10.8.2.1"], commands)
+
+    def test_skip_when_membership_unchanged(self):
+        self.builder.build(self._bundles(self.entries))
+        self.builder.build(self._bundles(self.entries))
+        self.assertEquals(self.push_ipset.call_count, 1)
+        self.assertEquals(self.push_iptables.call_count, len(constants.TABLES))
+        self.assertFalse(self.check_output.called)
+
+    def test_full_rebuild_on_delta_failure(self):
+        self.builder.build(self._bundles(self.entries[:2]))
+        self.check_output.side_effect = CalledProcessError(1, "ipset", output="boom")
+        self.builder.build(self._bundles(self.entries[1:]))
+        self.assertEquals(self.push_ipset.call_count, 2)
+
+
 def main():
     unittest.main()
 